@@ -1,30 +1,39 @@
 from __future__ import annotations
 import asyncio
-import json
 from datetime import datetime
 
 from playwright.async_api import async_playwright
-import aiofiles
+import orjson
 
 from src.settings import (
     app_logger,
+    setup_logging,
+    init_output_dir,
     DEBUG_MODE,
     TARGET_STORES,
-    STORAGE_STATE,
     JSON_LOG_FILE,
-    WEBHOOK_DELAY_SECONDS,
     SCRAPE_RETRY_ATTEMPTS,
     SCRAPE_RETRY_DELAY,
+    MAX_CONCURRENT_STORES,
+    CONTEXT_RECYCLE_EVERY,
+    CHROMIUM_ARGS,
     LOCAL_TIMEZONE,
 )
-from src.utils import ensure_storage_state
-from src.auth import check_if_login_needed, prime_master_session
+from src.utils import load_storage_state, block_heavy_resources, flush_screenshots
+from src.auth import check_if_login_needed, cookies_look_fresh, prime_master_session
 from src.metrics import scrape_store_metrics, scrape_inf_data
-from src.notifications import post_store_report, post_aggregate_summary
+from src.notifications import (
+    REPORT_TIME_FORMAT,
+    create_webhook_session,
+    post_store_report,
+    post_aggregate_summary,
+)
 
 playwright = None
 browser = None
-log_lock = asyncio.Lock()
+http_session = None
+store_contexts: dict = {}
+log_buffer: list[bytes] = []
 
 async def run_with_retries(func, *args, max_attempts=SCRAPE_RETRY_ATTEMPTS, attempt_delay=SCRAPE_RETRY_DELAY, **kwargs):
     for attempt in range(1, max_attempts + 1):
@@ -41,78 +50,179 @@ async def run_with_retries(func, *args, max_attempts=SCRAPE_RETRY_ATTEMPTS, atte
             await asyncio.sleep(attempt_delay)
 
 async def log_results(data: dict):
-    async with log_lock:
-        log_entry = {
-            'timestamp': datetime.now(LOCAL_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'),
-            **data,
-        }
+    log_entry = {
+        'timestamp': datetime.now(LOCAL_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'),
+        **data,
+    }
+    log_buffer.append(orjson.dumps(log_entry) + b'\n')
+
+def _flush_log_buffer():
+    if not log_buffer:
+        return
+    try:
+        with open(JSON_LOG_FILE, 'ab') as f:
+            f.write(b''.join(log_buffer))
+        log_buffer.clear()
+    except IOError as e:
+        app_logger.error(f"Error writing to JSON log file {JSON_LOG_FILE}: {e}")
+
+async def _new_store_context(storage_state: dict):
+    ctx = await browser.new_context(storage_state=storage_state)
+    store_contexts[ctx] = 0
+    await block_heavy_resources(ctx)
+    return ctx
+
+async def _release_context(ctx, ctx_pool: asyncio.Queue, storage_state: dict):
+    stale = None
+    try:
+        store_contexts[ctx] += 1
+        if store_contexts[ctx] >= CONTEXT_RECYCLE_EVERY:
+            try:
+                fresh = await _new_store_context(storage_state)
+            except Exception as e:
+                app_logger.warning(f"Could not recycle browser context, reusing the old one: {e}")
+            else:
+                del store_contexts[ctx]
+                stale, ctx = ctx, fresh
+    finally:
+        ctx_pool.put_nowait(ctx)
+    if stale is not None:
         try:
-            async with aiofiles.open(JSON_LOG_FILE, 'a', encoding='utf-8') as f:
-                await f.write(json.dumps(log_entry) + '\n')
-        except IOError as e:
-            app_logger.error(f"Error writing to JSON log file {JSON_LOG_FILE}: {e}")
+            await stale.close()
+        except Exception as e:
+            app_logger.warning(f"Error closing recycled browser context: {e}")
+
+async def _close_store_contexts():
+    contexts = list(store_contexts)
+    store_contexts.clear()
+    results = await asyncio.gather(*(ctx.close() for ctx in contexts), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            app_logger.warning(f"Error closing browser context: {result}")
+
+async def _scrape_inf_after_selection(page, store_info: dict, selected: asyncio.Event, metrics_task: asyncio.Future):
+    # The INF page has no store parameters; it shows whichever store the
+    # dashboard load selected, so wait for that before navigating.
+    selection = asyncio.ensure_future(selected.wait())
+    try:
+        await asyncio.wait({selection, metrics_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        selection.cancel()
+    if not selected.is_set():
+        return None
+    return await run_with_retries(scrape_inf_data, page, store_info)
+
+async def _process_store(store_info: dict, ctx_pool: asyncio.Queue, storage_state: dict) -> dict | None:
+    store_name = store_info.get('store_name', 'Unknown')
+    ctx = await ctx_pool.get()
+    app_logger.info(f"===== Processing Store: {store_name} =====")
+    pages = []
+    try:
+        page_m = await ctx.new_page()
+        pages.append(page_m)
+        page_i = await ctx.new_page()
+        pages.append(page_i)
+
+        selected = asyncio.Event()
+        metrics_task = asyncio.ensure_future(
+            run_with_retries(scrape_store_metrics, page_m, store_info, selected=selected)
+        )
+        metrics_data, inf_items = await asyncio.gather(
+            metrics_task,
+            _scrape_inf_after_selection(page_i, store_info, selected, metrics_task),
+            return_exceptions=True,
+        )
+        if isinstance(metrics_data, BaseException):
+            app_logger.error(f"Metrics task for {store_name} raised: {metrics_data}")
+            metrics_data = None
+        if isinstance(inf_items, BaseException):
+            app_logger.error(f"INF task for {store_name} raised: {inf_items}")
+            inf_items = None
+
+        if not metrics_data:
+            app_logger.error(f"Failed to retrieve any metrics for {store_name}. Skipping for this store.")
+            return None
+        combined_data = {**metrics_data, 'inf_items': inf_items if inf_items is not None else []}
+        await log_results(combined_data)
+        return combined_data
+
+    except Exception as e:
+        app_logger.error(f"An unexpected error occurred while processing {store_name}: {e}", exc_info=True)
+        return None
+    finally:
+        await asyncio.gather(*(page.close() for page in pages), return_exceptions=True)
+        await _release_context(ctx, ctx_pool, storage_state)
+
+async def _session_needs_login(storage_state: dict) -> bool:
+    ctx_check = await browser.new_context(storage_state=storage_state)
+    try:
+        return await check_if_login_needed(await ctx_check.new_page(), TARGET_STORES[0]['dash_url'])
+    finally:
+        await ctx_check.close()
+
+async def _scrape_all_stores(storage_state: dict) -> list[dict]:
+    ctx_pool = asyncio.Queue()
+    for _ in range(min(MAX_CONCURRENT_STORES, len(TARGET_STORES))):
+        ctx_pool.put_nowait(await _new_store_context(storage_state))
+    results = await asyncio.gather(
+        *[_process_store(s, ctx_pool, storage_state) for s in TARGET_STORES],
+        return_exceptions=True,
+    )
+    all_results = []
+    for store_info, result in zip(TARGET_STORES, results):
+        if isinstance(result, BaseException):
+            app_logger.error(f"Store task for {store_info.get('store_name', 'Unknown')} raised: {result}")
+        elif result:
+            all_results.append(result)
+    return all_results
 
 async def main():
-    global playwright, browser
+    global playwright, browser, http_session
     app_logger.info("Starting up unified scraper (Metrics + INF)...")
     if not TARGET_STORES:
         app_logger.critical("`target_stores` is empty or not found in config.json. Aborting.")
         return
     try:
         playwright = await async_playwright().start()
-        browser = await playwright.chromium.launch(headless=not DEBUG_MODE)
+        browser = await playwright.chromium.launch(headless=not DEBUG_MODE, args=CHROMIUM_ARGS)
 
         login_required = True
-        if ensure_storage_state():
+        session_check_skipped = False
+        storage_state = await asyncio.to_thread(load_storage_state)
+        if storage_state and cookies_look_fresh(storage_state):
+            app_logger.info("Saved session cookies are still fresh; skipping session check.")
+            login_required = False
+            session_check_skipped = True
+        elif storage_state:
             app_logger.info("Found existing storage_state; verifying session.")
-            ctx_check = await browser.new_context(storage_state=json.load(open(STORAGE_STATE)))
-            test_url = (
-                f"https://sellercentral.amazon.co.uk/snowdash?mons_sel_dir_mcid={TARGET_STORES[0]['merchant_id']}"
-                f"&mons_sel_mkid={TARGET_STORES[0]['marketplace_id']}"
-            )
-            login_required = await check_if_login_needed(await ctx_check.new_page(), test_url)
-            await ctx_check.close()
+            login_required = await _session_needs_login(storage_state)
 
         if login_required:
-            if not await prime_master_session(browser):
+            storage_state = await prime_master_session(browser)
+            if not storage_state:
                 app_logger.critical("Could not establish a login session. Aborting.")
                 return
 
-        storage_state = json.load(open(STORAGE_STATE))
-        all_results = []
-        for store_info in TARGET_STORES:
-            store_name = store_info.get('store_name', 'Unknown')
-            app_logger.info(f"===== Processing Store: {store_name} =====")
-            ctx = None
-            try:
-                ctx = await browser.new_context(storage_state=storage_state)
-                page = await ctx.new_page()
-
-                metrics_data = await run_with_retries(scrape_store_metrics, page, store_info)
-                inf_items = await run_with_retries(scrape_inf_data, page, store_info)
-
-                if metrics_data:
-                    combined_data = {**metrics_data, 'inf_items': inf_items if inf_items is not None else []}
-                    all_results.append(combined_data)
-                    await log_results(combined_data)
+        all_results = await _scrape_all_stores(storage_state)
+        if not all_results and session_check_skipped:
+            app_logger.warning("No store data with the unverified saved session; re-checking login.")
+            await _close_store_contexts()
+            if await _session_needs_login(storage_state):
+                storage_state = await prime_master_session(browser)
+                if storage_state:
+                    all_results = await _scrape_all_stores(storage_state)
                 else:
-                    app_logger.error(f"Failed to retrieve any metrics for {store_name}. Skipping for this store.")
-
-            except Exception as e:
-                app_logger.error(f"An unexpected error occurred while processing {store_name}: {e}", exc_info=True)
-            finally:
-                if ctx:
-                    await ctx.close()
+                    app_logger.critical("Could not re-establish a login session.")
+        await asyncio.to_thread(_flush_log_buffer)
 
         if all_results:
             app_logger.info(f"Scraping complete. Sending {len(all_results)} store reports...")
-            for result in all_results:
-                await post_store_report(result)
-                app_logger.info(f"Waiting {WEBHOOK_DELAY_SECONDS}s before next webhook post...")
-                await asyncio.sleep(WEBHOOK_DELAY_SECONDS)
+            http_session = create_webhook_session()
+            timestamp = datetime.now(LOCAL_TIMEZONE).strftime(REPORT_TIME_FORMAT)
+            await asyncio.gather(*[post_store_report(r, http_session, timestamp) for r in all_results])
 
             app_logger.info("Sending aggregate summary report...")
-            await post_aggregate_summary(all_results)
+            await post_aggregate_summary(all_results, http_session, timestamp)
             app_logger.info(
                 f"Run completed. Processed {len(all_results)}/{len(TARGET_STORES)} stores successfully."
             )
@@ -123,6 +233,11 @@ async def main():
         app_logger.critical(f"A critical error occurred in main execution: {e}", exc_info=True)
     finally:
         app_logger.info("Shutting down...")
+        await asyncio.to_thread(_flush_log_buffer)
+        if http_session:
+            await http_session.close()
+        await flush_screenshots()
+        await _close_store_contexts()
         if browser:
             await browser.close()
         if playwright:
@@ -130,4 +245,15 @@ async def main():
         app_logger.info("Shutdown complete.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    log_listener = setup_logging()
+    init_output_dir()
+    try:
+        try:
+            import uvloop
+        except ImportError:
+            asyncio.run(main())
+        else:
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(main())
+    finally:
+        log_listener.stop()
@@ -1,6 +1,9 @@
 from __future__ import annotations
+import time
+import asyncio
+from typing import Awaitable
 import pyotp
-from playwright.async_api import Page, Browser, expect
+from playwright.async_api import Page, Browser
 from .settings import (
     LOGIN_URL,
     PAGE_TIMEOUT,
@@ -9,17 +12,61 @@ from .settings import (
     TARGET_STORES,
     app_logger,
     DEBUG_MODE,
-    config,
+    SETTINGS,
 )
 from .utils import save_screenshot
 
+_CLICK_CONTINUE_JS = """() => {
+    const el = [...document.querySelectorAll('button')].find(b => b.textContent.includes('Continue shopping'))
+        || document.querySelector('input[type="submit"][aria-labelledby="continue-announce"]');
+    if (!el) return false;
+    el.click();
+    return true;
+}"""
+
+_AUTH_COOKIE_NAMES = frozenset({'at-acbuk', 'sess-at-acbuk'})
+
+_TOTP = pyotp.TOTP(SETTINGS.otp_secret_key) if SETTINGS.otp_secret_key else None
+
+def is_signin_url(url: str) -> bool:
+    return "signin" in url.lower() or "/ap/" in url
+
+async def _first_completed(waiters: dict[str, Awaitable]) -> str:
+    tasks = {asyncio.ensure_future(w): name for name, w in waiters.items()}
+    pending = set(tasks)
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return tasks[task]
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def cookies_look_fresh(storage_state: dict, slack_sec: int = 600) -> bool:
+    auth_cookies = [
+        c for c in storage_state.get('cookies', [])
+        if 'amazon.co.uk' in c.get('domain', '') and c.get('name') in _AUTH_COOKIE_NAMES
+    ]
+    if not auth_cookies:
+        return False
+    cutoff = time.time() + slack_sec
+    return all(c.get('expires', -1) > cutoff for c in auth_cookies)
+
 async def check_if_login_needed(page: Page, test_url: str) -> bool:
     try:
-        await page.goto(test_url, timeout=PAGE_TIMEOUT, wait_until="load")
-        if "signin" in page.url.lower() or "/ap/" in page.url:
+        await page.goto(test_url, timeout=PAGE_TIMEOUT, wait_until="domcontentloaded")
+        outcome = await _first_completed({
+            'signin': page.wait_for_url(is_signin_url, timeout=WAIT_TIMEOUT),
+            'dashboard': page.locator("kat-table >> nth=0").wait_for(state="visible", timeout=WAIT_TIMEOUT),
+        })
+        if outcome == 'signin':
             app_logger.info("Session invalid, login required.")
             return True
-        await expect(page.locator("kat-table >> nth=0")).to_be_visible(timeout=WAIT_TIMEOUT)
         app_logger.info("Existing session still valid (metrics table found).")
         return False
     except Exception as e:
@@ -29,28 +76,23 @@ async def check_if_login_needed(page: Page, test_url: str) -> bool:
 async def perform_login(page: Page) -> bool:
     app_logger.info("Starting login flow")
     try:
-        await page.goto(LOGIN_URL, timeout=PAGE_TIMEOUT, wait_until="load")
-
-        email_sel = "input#ap_email"
-        continue_btn = 'button:has-text("Continue shopping")'
-        continue_input = 'input[type="submit"][aria-labelledby="continue-announce"]'
-        await page.wait_for_selector(f"{email_sel}, {continue_btn}, {continue_input}", timeout=WAIT_TIMEOUT)
+        await page.goto(LOGIN_URL, timeout=PAGE_TIMEOUT, wait_until="domcontentloaded")
 
-        if await page.locator(continue_btn).is_visible():
-            await page.locator(continue_btn).click()
-        elif await page.locator(continue_input).is_visible():
-            await page.locator(continue_input).click()
+        if await page.evaluate(_CLICK_CONTINUE_JS):
+            app_logger.info("Dismissed 'continue' interstitial before sign-in.")
 
-        await page.get_by_label("Email or mobile phone number").fill(config['login_email'])
+        await page.get_by_label("Email or mobile phone number").fill(SETTINGS.login_email)
         await page.get_by_label("Continue").click()
-        await page.get_by_label("Password").fill(config['login_password'])
+        await page.get_by_label("Password").fill(SETTINGS.login_password)
 
         async with page.expect_navigation(wait_until="domcontentloaded", timeout=WAIT_TIMEOUT):
             await page.get_by_label("Sign in").click()
 
         if "mfa" in page.url:
             app_logger.info("OTP challenge detected.")
-            code = pyotp.TOTP(config['otp_secret_key']).now()
+            if _TOTP is None:
+                raise ValueError("otp_secret_key is not configured")
+            code = _TOTP.now()
             await page.locator('input[id*="otp"]').fill(code)
             async with page.expect_navigation(wait_until="load", timeout=WAIT_TIMEOUT):
                 await page.get_by_role("button", name="Sign in").click()
@@ -63,35 +105,30 @@ async def perform_login(page: Page) -> bool:
         await save_screenshot(page, "login_failure")
         return False
 
-async def prime_master_session(browser: Browser) -> bool:
+async def prime_master_session(browser: Browser) -> dict | None:
     app_logger.info("Priming master session")
     ctx = await browser.new_context()
     page = await ctx.new_page()
     try:
         if not await perform_login(page):
-            return False
-
-        first_store = TARGET_STORES[0]
-        test_url = (
-            f"https://sellercentral.amazon.co.uk/snowdash"
-            f"?mons_sel_dir_mcid={first_store['merchant_id']}"
-            f"&mons_sel_mkid={first_store['marketplace_id']}"
-        )
+            return None
+
+        test_url = TARGET_STORES[0]['dash_url']
         app_logger.info(f"Verifying session by navigating to dashboard: {test_url}")
 
         login_needed = await check_if_login_needed(page, test_url)
         if login_needed:
             app_logger.critical("Session verification failed: still requires login after login flow.")
             await save_screenshot(page, "session_verification_failure")
-            return False
+            return None
 
-        await ctx.storage_state(path=STORAGE_STATE)
+        storage_state = await ctx.storage_state(path=STORAGE_STATE)
         app_logger.info("Saved new session state.")
-        return True
+        return storage_state
 
     except Exception as e:
         app_logger.critical(f"An unexpected error occurred during session priming: {e}", exc_info=True)
         await save_screenshot(page, "session_priming_error")
-        return False
+        return None
     finally:
         await ctx.close()
@@ -1,7 +1,11 @@
 from __future__ import annotations
 import re
+import asyncio
 from datetime import datetime
-from playwright.async_api import Page, TimeoutError, expect
+from typing import Awaitable
+from urllib.parse import urlsplit
+import orjson
+from playwright.async_api import Page, Response, TimeoutError, expect
 from .settings import (
     PAGE_TIMEOUT,
     WAIT_TIMEOUT,
@@ -11,84 +15,146 @@ from .settings import (
     app_logger,
 )
 from .utils import save_screenshot
+from .auth import is_signin_url
 
-async def scrape_store_metrics(page: Page, store_info: dict) -> dict | None:
+_IMG_SIZE_RE = re.compile(r"\._SS\d+_\.")
+
+def _is_metrics_response(response: Response) -> bool:
+    return urlsplit(response.url).path.endswith("/api/metrics") and response.request.method != "OPTIONS"
+
+async def _drain_metrics_response(page: Page, action: Awaitable, timeout: float) -> bool:
+    waiter = asyncio.ensure_future(page.wait_for_response(_is_metrics_response, timeout=timeout))
+    try:
+        await action
+    except BaseException:
+        waiter.cancel()
+        raise
+    try:
+        await waiter
+        return True
+    except TimeoutError:
+        return False
+
+async def _open_dashboard(page: Page, dash_url: str) -> None:
+    await page.goto(dash_url, timeout=PAGE_TIMEOUT, wait_until='domcontentloaded')
+    if is_signin_url(page.url):
+        raise RuntimeError("redirected to sign-in; the saved session is no longer valid")
+
+_WATCH_FIRST_ROW_JS = """(sel) => {
+    const firstRowText = () => document.querySelector(sel)?.textContent ?? null;
+    const before = firstRowText();
+    window.__infSortDone = false;
+    const observer = new MutationObserver(() => {
+        const now = firstRowText();
+        if (now !== null && now !== before) {
+            window.__infSortDone = true;
+            observer.disconnect();
+        }
+    });
+    observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+}"""
+
+async def scrape_store_metrics(page: Page, store_info: dict, selected: asyncio.Event | None = None) -> dict | None:
     store_name = store_info['store_name']
-    app_logger.info(f"Starting METRICS data collection for '{store_name}'")
+    app_logger.info("Starting METRICS data collection for '%s'", store_name)
     try:
-        dash_url = (
-            f"https://sellercentral.amazon.co.uk/snowdash?mons_sel_dir_mcid={store_info['merchant_id']}"
-            f"&mons_sel_mkid={store_info['marketplace_id']}"
-        )
-        await page.goto(dash_url, timeout=PAGE_TIMEOUT)
-        await expect(page.get_by_role("button", name="Refresh")).to_be_visible(timeout=WAIT_TIMEOUT)
-
-        customise_btn = page.locator("#content span:has-text('Customised')").nth(0)
-        await expect(customise_btn).to_be_visible(timeout=WAIT_TIMEOUT)
-        await page.wait_for_timeout(5000)
-        await expect(customise_btn).to_be_enabled(timeout=WAIT_TIMEOUT)
-        await customise_btn.click(timeout=ACTION_TIMEOUT)
-        await expect(page.locator("kat-date-range-picker")).to_be_visible(timeout=WAIT_TIMEOUT)
+        if not await _drain_metrics_response(page, _open_dashboard(page, store_info['dash_url']), WAIT_TIMEOUT):
+            app_logger.warning("No initial METRICS API call seen for %s; continuing to date selection.", store_name)
+        if selected is not None:
+            selected.set()
+
+        if not await _drain_metrics_response(
+            page,
+            page.locator("#content span:has-text('Customised')").first.click(timeout=ACTION_TIMEOUT),
+            15000,
+        ):
+            app_logger.info("No METRICS API call after opening Customised for %s.", store_name)
+
         now = datetime.now(LOCAL_TIMEZONE).strftime("%m/%d/%Y")
         date_inputs = page.locator('kat-date-range-picker input[type="text"]')
         await date_inputs.nth(0).fill(now)
         await date_inputs.nth(1).fill(now)
-        async with page.expect_response(lambda r: "/api/metrics" in r.url, timeout=40000) as response_info:
+        async with page.expect_response(_is_metrics_response, timeout=40000) as response_info:
             await page.get_by_role("button", name="Apply").click(timeout=ACTION_TIMEOUT)
-        api_data = await (await response_info.value).json()
-        app_logger.info(f"Received METRICS API response for {store_name}.")
+        response = await response_info.value
+        try:
+            api_data = orjson.loads(await response.body())
+        except orjson.JSONDecodeError:
+            api_data = await response.json()
+        app_logger.info("Received METRICS API response for %s.", store_name)
 
-        shopper_stats = []
-        store_totals = {'units':0, 'time':0, 'orders':0, 'req_units':0, 'inf_items':0, 'lates':0}
+        rows = []
         for entry in api_data:
-            m = entry.get('metrics', {})
+            if entry.get('type') != 'MASTER':
+                continue
             name = entry.get('shopperName')
-            if entry.get('type') == 'MASTER' and name and name != 'SHOPPER_NAME_NOT_FOUND':
-                orders = m.get('OrdersShopped_V2', 0)
-                if orders == 0:
-                    continue
-                units = m.get('PickedUnits_V2', 0)
-                time_sec = m.get('PickTimeInSec_V2', 0)
-                shopper_stats.append({
-                    'name': name,
-                    'uph': f"{(units / (time_sec / 3600)) if time_sec > 0 else 0:.0f}",
-                    'inf': f"{m.get('ItemNotFoundRate_V2',0):.1f} %",
-                    'lates': f"{m.get('LatePicksRate',0):.1f} %",
-                    'orders': int(orders)
-                })
-                store_totals['units'] += units
-                store_totals['time'] += time_sec
-                store_totals['orders'] += orders
-                req_units = m.get('RequestedQuantity_V2', 0)
-                store_totals['req_units'] += req_units
-                store_totals['inf_items'] += req_units * (m.get('ItemNotFoundRate_V2', 0) / 100.0)
-                store_totals['lates'] += orders * (m.get('LatePicksRate', 0) / 100.0)
-
-        if not shopper_stats:
-            app_logger.warning(f"No active shoppers found for {store_name}.")
+            if not name or name == 'SHOPPER_NAME_NOT_FOUND':
+                continue
+            get = entry.get('metrics', {}).get
+            shopped = get('OrdersShopped_V2', 0)
+            if not shopped:
+                continue
+            rows.append((
+                name,
+                get('PickedUnits_V2', 0),
+                get('PickTimeInSec_V2', 0),
+                shopped,
+                get('RequestedQuantity_V2', 0),
+                get('ItemNotFoundRate_V2', 0),
+                get('LatePicksRate', 0),
+            ))
+        if not rows:
+            app_logger.warning("No active shoppers found for %s.", store_name)
             return {'overall': {'store': store_name}, 'shoppers': []}
 
-        overall_uph = (store_totals['units']/(store_totals['time']/3600)) if store_totals['time']>0 else 0
-        overall_inf = (store_totals['inf_items']/store_totals['req_units'])*100 if store_totals['req_units']>0 else 0
-        overall_lates = (store_totals['lates']/store_totals['orders'])*100 if store_totals['orders']>0 else 0
+        names, units, time_sec, orders, req_units, inf_rate, lates_rate = zip(*rows)
+
+        shoppers = []
+        for i in sorted(range(len(rows)), key=inf_rate.__getitem__):
+            uph = round((units[i] / (time_sec[i] / 3600)) if time_sec[i] > 0 else 0)
+            inf = round(inf_rate[i], 1)
+            lates = round(lates_rate[i], 1)
+            shoppers.append({
+                'name': names[i],
+                'uph': f"{uph:.0f}",
+                'inf': f"{inf:.1f} %",
+                'lates': f"{lates:.1f} %",
+                'orders': int(orders[i]),
+                'uph_value': uph,
+                'inf_value': inf,
+                'lates_value': lates,
+            })
+
+        total_units = sum(units)
+        total_time = sum(time_sec)
+        total_orders = sum(orders)
+        total_req_units = sum(req_units)
+        total_inf_items = sum(r * (i / 100.0) for r, i in zip(req_units, inf_rate))
+        total_lates = sum(o * (l / 100.0) for o, l in zip(orders, lates_rate))
+
+        overall_uph = round((total_units/(total_time/3600)) if total_time>0 else 0)
+        overall_inf = round((total_inf_items/total_req_units)*100 if total_req_units>0 else 0, 1)
+        overall_lates = round((total_lates/total_orders)*100 if total_orders>0 else 0, 1)
         overall = {
             'store': store_name,
-            'orders': str(int(store_totals['orders'])),
-            'units': str(int(store_totals['units'])),
+            'orders': str(int(total_orders)),
+            'units': str(int(total_units)),
             'uph': f"{overall_uph:.0f}",
             'inf': f"{overall_inf:.1f} %",
             'lates': f"{overall_lates:.1f} %",
+            'uph_value': overall_uph,
+            'inf_value': overall_inf,
+            'lates_value': overall_lates,
         }
-        shoppers = sorted(shopper_stats, key=lambda x: float(x['inf'].replace('%','').strip()))
         return {'overall': overall, 'shoppers': shoppers}
     except Exception as e:
-        app_logger.error(f"Error scraping metrics for {store_name}: {e}", exc_info=True)
+        app_logger.error("Error scraping metrics for %s: %s", store_name, e, exc_info=True)
         await save_screenshot(page, f"{store_name}_metrics_error")
         return None
 
 async def scrape_inf_data(page: Page, store_info: dict) -> list[dict] | None:
     store_name = store_info['store_name']
-    app_logger.info(f"Starting INF data collection for '{store_name}'")
+    app_logger.info("Starting INF data collection for '%s'", store_name)
     try:
         url = 'https://sellercentral.amazon.co.uk/snow-inventory/inventoryinsights/ref=xx_infr_dnav_xx'
         await page.goto(url, timeout=PAGE_TIMEOUT, wait_until='domcontentloaded')
@@ -98,38 +164,46 @@ async def scrape_inf_data(page: Page, store_info: dict) -> list[dict] | None:
         try:
             await expect(page.locator(f"{table_sel} tr").first).to_be_visible(timeout=20000)
         except TimeoutError:
-            app_logger.info(f"No INF data rows found for '{store_name}'; returning empty list.")
+            app_logger.info("No INF data rows found for '%s'; returning empty list.", store_name)
             return []
 
-        first_row_before_sort = await page.locator(f"{table_sel} tr").first.text_content()
-        app_logger.info(f"Sorting table by 'INF Units' for '{store_name}'")
+        app_logger.info("Sorting table by 'INF Units' for '%s'", store_name)
+        await page.evaluate(_WATCH_FIRST_ROW_JS, f"{table_sel} tr")
         await page.locator('#sort-3').click()
         try:
-            await page.wait_for_function(
-                expression='(args) => { const [selector, initialText] = args; const firstRow = document.querySelector(selector); return firstRow && firstRow.textContent !== initialText; }',
-                arg=[f"{table_sel} tr", first_row_before_sort],
-                timeout=20000,
-            )
+            await page.wait_for_function("() => window.__infSortDone === true", timeout=20000)
             app_logger.info('Table sort confirmed by DOM change.')
         except TimeoutError:
             app_logger.warning('Table content did not change after sort click. Proceeding with current data (might be pre-sorted or single-page).')
 
-        rows = await page.locator(f"{table_sel} tr").all()
+        rows_data = await page.evaluate(
+            '''(sel) => Array.from(document.querySelectorAll(sel)).slice(0, 5).map(r => {
+                const c = r.querySelectorAll('td');
+                const text = (i, q) => c[i]?.querySelector(q)?.innerText ?? '';
+                return {
+                    thumb: c[0]?.querySelector('img')?.getAttribute('src') || '',
+                    sku: text(1, 'span'),
+                    product_name: text(2, 'a span'),
+                    inf_units: text(3, 'span'),
+                    orders_impacted: text(4, 'span'),
+                    inf_pct: text(8, 'span'),
+                };
+            })''',
+            f"{table_sel} tr",
+        )
         items = []
-        for r in rows[:5]:
-            cells = r.locator('td')
-            thumb = await cells.nth(0).locator('img').get_attribute('src') or ''
+        for r in rows_data:
             items.append({
-                'image_url': re.sub(r"\._SS\d+_\.", f"._SS{SMALL_IMAGE_SIZE}_.", thumb),
-                'sku': await cells.nth(1).locator('span').inner_text(),
-                'product_name': await cells.nth(2).locator('a span').inner_text(),
-                'inf_units': await cells.nth(3).locator('span').inner_text(),
-                'orders_impacted': await cells.nth(4).locator('span').inner_text(),
-                'inf_pct': await cells.nth(8).locator('span').inner_text(),
+                'image_url': _IMG_SIZE_RE.sub(f"._SS{SMALL_IMAGE_SIZE}_.", r['thumb']),
+                'sku': r['sku'],
+                'product_name': r['product_name'],
+                'inf_units': r['inf_units'],
+                'orders_impacted': r['orders_impacted'],
+                'inf_pct': r['inf_pct'],
             })
-        app_logger.info(f"Scraped top {len(items)} INF items for '{store_name}'")
+        app_logger.info("Scraped top %d INF items for '%s'", len(items), store_name)
         return items
     except Exception as e:
-        app_logger.error(f"Error scraping INF data for {store_name}: {e}", exc_info=True)
+        app_logger.error("Error scraping INF data for %s: %s", store_name, e, exc_info=True)
         await save_screenshot(page, f"{store_name}_inf_error")
         return None
@@ -1,18 +1,26 @@
 from __future__ import annotations
-import re
+import gzip
+import asyncio
 import urllib.parse
+from functools import lru_cache
 from datetime import datetime
 import aiohttp
 import ssl
 import certifi
+import orjson
+from aiolimiter import AsyncLimiter
 from .settings import (
     CHAT_WEBHOOK_URL,
     SUMMARY_CHAT_WEBHOOK_URL,
+    WEBHOOK_GZIP,
     UPH_THRESHOLD,
     LATES_THRESHOLD,
     INF_THRESHOLD,
     QR_CODE_SIZE,
-    WEBHOOK_DELAY_SECONDS,
+    WEBHOOK_MAX_RATE,
+    WEBHOOK_RATE_PERIOD,
+    WEBHOOK_MAX_ATTEMPTS,
+    WEBHOOK_MAX_RETRY_AFTER,
     COLOR_GOOD,
     COLOR_BAD,
     EMOJI_GREEN_CHECK,
@@ -20,56 +28,110 @@ from .settings import (
     LOCAL_TIMEZONE,
     app_logger,
 )
-from .utils import save_screenshot  # not used maybe
 
-async def post_to_webhook(url: str, payload: dict, store_name: str, hook_type: str):
+REPORT_TIME_FORMAT = '%A %d %B, %H:%M'
+_SSL_CTX = ssl.create_default_context(cafile=certifi.where())
+_JSON_HEADERS = {'Content-Type': 'application/json; charset=UTF-8'}
+_GZIP_JSON_HEADERS = {**_JSON_HEADERS, 'Content-Encoding': 'gzip'}
+_QR_PREFIX = f"https://api.qrserver.com/v1/create-qr-code/?size={QR_CODE_SIZE}x{QR_CODE_SIZE}&data="
+_webhook_limiter = AsyncLimiter(max_rate=WEBHOOK_MAX_RATE, time_period=WEBHOOK_RATE_PERIOD)
+
+@lru_cache(maxsize=1024)
+def _qr_url(sku: str) -> str:
+    encoded = sku if sku.isalnum() and sku.isascii() else urllib.parse.quote(sku, safe='')
+    return _QR_PREFIX + encoded
+
+@lru_cache(maxsize=128)
+def _short_name(full_store_name: str) -> str:
+    return full_store_name.split(' - ')[-1] if ' - ' in full_store_name else full_store_name
+
+def create_webhook_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(ssl=_SSL_CTX, limit=20, ttl_dns_cache=300, keepalive_timeout=30),
+    )
+
+def _retry_after_seconds(header: str | None) -> float:
+    try:
+        delay = float(header)
+    except (TypeError, ValueError):
+        return WEBHOOK_RATE_PERIOD
+    return delay if delay >= 0 else 0.0
+
+async def post_to_webhook(url: str, payload: dict, store_name: str, hook_type: str, session: aiohttp.ClientSession):
     if not url:
         return
     try:
-        timeout = aiohttp.ClientTimeout(total=30)
-        ssl_ctx = ssl.create_default_context(cafile=certifi.where())
-        async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(ssl=ssl_ctx)) as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.status != 200:
-                    err = await resp.text()
-                    app_logger.error(f"{hook_type} webhook failed for {store_name}. Status: {resp.status}, Response: {err}")
-                else:
-                    app_logger.info(f"Successfully posted to {hook_type} webhook for {store_name}.")
+        body = orjson.dumps(payload)
+        headers = _JSON_HEADERS
+        if WEBHOOK_GZIP:
+            body = gzip.compress(body)
+            headers = _GZIP_JSON_HEADERS
+        for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+            async with _webhook_limiter:
+                async with session.post(url, data=body, headers=headers) as resp:
+                    if resp.status == 429 and attempt < WEBHOOK_MAX_ATTEMPTS:
+                        delay = _retry_after_seconds(resp.headers.get('Retry-After'))
+                        if delay > WEBHOOK_MAX_RETRY_AFTER:
+                            app_logger.error("%s webhook rate-limited for %s with Retry-After %ss; giving up.", hook_type, store_name, delay)
+                            return
+                        app_logger.warning("%s webhook rate-limited for %s. Retrying in %ss...", hook_type, store_name, delay)
+                    elif resp.status != 200:
+                        err = await resp.text()
+                        app_logger.error("%s webhook failed for %s. Status: %s, Response: %s", hook_type, store_name, resp.status, err)
+                        return
+                    else:
+                        app_logger.info("Successfully posted to %s webhook for %s.", hook_type, store_name)
+                        return
+            await asyncio.sleep(delay)
     except Exception as e:
-        app_logger.error(f"Error posting to {hook_type} webhook for {store_name}: {e}", exc_info=True)
+        app_logger.error("Error posting to %s webhook for %s: %s", hook_type, store_name, e, exc_info=True)
 
 
-def _format_metric_with_emoji(value_str: str, threshold: float, is_uph: bool = False) -> str:
-    try:
-        numeric_value = float(re.sub(r'[^\d.]', '', value_str))
-        is_good = (numeric_value >= threshold) if is_uph else (numeric_value <= threshold)
-        return f"{value_str} {EMOJI_GREEN_CHECK if is_good else EMOJI_RED_CROSS}"
-    except (ValueError, TypeError):
-        return value_str
+SHOPPER_METRICS_TPL = (
+    '<font color="{c_uph}"><b>UPH:</b> {uph}</font> | '
+    '<font color="{c_inf}"><b>INF:</b> {inf}</font> | '
+    '<font color="{c_lates}"><b>Lates:</b> {lates}</font>'
+)
+METRIC_TPL = '<font color="{color}"><b>{label}:</b> {text}</font>'
+INF_ITEM_TPL = (
+    '<b>{product_name}</b><br><b>SKU:</b> {sku}<br>'
+    '<b>INF Units:</b> {inf_units} ({inf_pct}) | <b>Orders:</b> {orders_impacted}'
+)
 
+def _meets_threshold(numeric_value: float, threshold: float, is_uph: bool = False) -> bool:
+    return (numeric_value >= threshold) if is_uph else (numeric_value <= threshold)
 
-def _format_metric_with_color(value_str: str, threshold: float, is_uph: bool = False) -> str:
-    try:
-        numeric_value = float(re.sub(r'[^\d.]', '', value_str))
-        is_good = (numeric_value >= threshold) if is_uph else (numeric_value <= threshold)
-        return f'<font color="{COLOR_GOOD if is_good else COLOR_BAD}">{value_str}</font>'
-    except (ValueError, TypeError):
-        return value_str
 
-async def post_store_report(data: dict):
+def _color(value: float, threshold: float, is_uph: bool = False) -> str:
+    return COLOR_GOOD if _meets_threshold(value, threshold, is_uph) else COLOR_BAD
+
+
+def _metric_html(label: str, text: str, value: float | None, threshold: float, is_uph: bool = False) -> str:
+    if value is None:
+        return f"<b>{label}:</b> N/A"
+    return METRIC_TPL.format(color=_color(value, threshold, is_uph), label=label, text=text)
+
+
+def _format_num_with_emoji(value: float, decimals: int, threshold: float, is_uph: bool = False, suffix: str = '') -> str:
+    value = round(value, decimals)
+    is_good = _meets_threshold(value, threshold, is_uph)
+    return f"{value:.{decimals}f}{suffix} {EMOJI_GREEN_CHECK if is_good else EMOJI_RED_CROSS}"
+
+async def post_store_report(data: dict, session: aiohttp.ClientSession, timestamp: str | None = None):
     overall = data.get('overall', {})
     shoppers = data.get('shoppers', [])
     inf_items = data.get('inf_items', [])
     full_store_name = overall.get('store', 'Unknown Store')
-    timestamp = datetime.now(LOCAL_TIMEZONE).strftime('%A %d %B, %H:%M')
-    short_store_name = full_store_name.split(' - ')[-1] if ' - ' in full_store_name else full_store_name
+    if timestamp is None:
+        timestamp = datetime.now(LOCAL_TIMEZONE).strftime(REPORT_TIME_FORMAT)
 
     sections = []
     if shoppers:
         summary_text = (
-            f"• <b>UPH:</b> {_format_metric_with_emoji(overall.get('uph'), UPH_THRESHOLD, is_uph=True)}<br>"
-            f"• <b>Lates:</b> {_format_metric_with_emoji(overall.get('lates'), LATES_THRESHOLD)}<br>"
-            f"• <b>INF:</b> {_format_metric_with_emoji(overall.get('inf'), INF_THRESHOLD)}<br>"
+            f"• <b>UPH:</b> {_format_num_with_emoji(overall['uph_value'], 0, UPH_THRESHOLD, True)}<br>"
+            f"• <b>Lates:</b> {_format_num_with_emoji(overall['lates_value'], 1, LATES_THRESHOLD, suffix=' %')}<br>"
+            f"• <b>INF:</b> {_format_num_with_emoji(overall['inf_value'], 1, INF_THRESHOLD, suffix=' %')}<br>"
             f"• <b>Orders:</b> {overall.get('orders')}"
         )
         sections.append({'header': 'Store-Wide Performance', 'widgets': [{'textParagraph': {'text': summary_text}}]})
@@ -79,19 +141,20 @@ async def post_store_report(data: dict):
     if shoppers:
         shopper_widgets = []
         for s in shoppers:
-            uph = _format_metric_with_color(f"<b>UPH:</b> {s['uph']}", UPH_THRESHOLD, True)
-            inf = _format_metric_with_color(f"<b>INF:</b> {s['inf']}", INF_THRESHOLD)
-            lates = _format_metric_with_color(f"<b>Lates:</b> {s['lates']}", LATES_THRESHOLD)
-            shopper_widgets.append({'decoratedText': {'icon': {'knownIcon': 'PERSON'}, 'topLabel': f"<b>{s['name']}</b> ({s['orders']} Orders)", 'text': f"{uph} | {inf} | {lates}"}})
+            metrics_text = SHOPPER_METRICS_TPL.format(
+                uph=s['uph'], c_uph=_color(s['uph_value'], UPH_THRESHOLD, True),
+                inf=s['inf'], c_inf=_color(s['inf_value'], INF_THRESHOLD),
+                lates=s['lates'], c_lates=_color(s['lates_value'], LATES_THRESHOLD),
+            )
+            shopper_widgets.append({'decoratedText': {'icon': {'knownIcon': 'PERSON'}, 'topLabel': f"<b>{s['name']}</b> ({s['orders']} Orders)", 'text': metrics_text}})
         sections.append({'header': f"Per-Shopper Breakdown ({len(shoppers)})", 'collapsible': True, 'widgets': shopper_widgets})
 
     if inf_items:
         inf_widgets = [{'divider': {}}]
         for it in inf_items:
-            qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size={QR_CODE_SIZE}x{QR_CODE_SIZE}&data={urllib.parse.quote(it['sku'])}"
-            left_col = {'horizontalSizeStyle': 'FILL_MINIMUM_SPACE', 'widgets': [{'image': {'imageUrl': qr_url}}]}
+            left_col = {'horizontalSizeStyle': 'FILL_MINIMUM_SPACE', 'widgets': [{'image': {'imageUrl': _qr_url(it['sku'])}}]}
             right_col = {'widgets': [
-                {'textParagraph': {'text': f"<b>{it['product_name']}</b><br><b>SKU:</b> {it['sku']}<br><b>INF Units:</b> {it['inf_units']} ({it['inf_pct']}) | <b>Orders:</b> {it['orders_impacted']}"}},
+                {'textParagraph': {'text': INF_ITEM_TPL.format_map(it)}},
                 {'image': {'imageUrl': it['image_url']}}
             ]}
             inf_widgets.extend([{'columns': {'columnItems': [left_col, right_col]}}, {'divider': {}}])
@@ -102,7 +165,7 @@ async def post_store_report(data: dict):
             'cardId': f"store-report-{full_store_name.replace(' ', '-')}",
             'card': {
                 'header': {
-                    'title': short_store_name,
+                    'title': _short_name(full_store_name),
                     'subtitle': timestamp,
                     'imageUrl': 'https://i.pinimg.com/originals/01/ca/da/01cada77a0a7d326d85b7969fe26a728.jpg',
                     'imageType': 'CIRCLE'
@@ -111,12 +174,14 @@ async def post_store_report(data: dict):
             }
         }]
     }
-    await post_to_webhook(CHAT_WEBHOOK_URL, payload, full_store_name, 'per-store')
+    await post_to_webhook(CHAT_WEBHOOK_URL, payload, full_store_name, 'per-store', session)
 
-async def post_aggregate_summary(results: list):
+async def post_aggregate_summary(results: list, session: aiohttp.ClientSession, timestamp: str | None = None):
     successful_results = [r for r in results if r.get('overall', {}).get('store')]
     if not SUMMARY_CHAT_WEBHOOK_URL or not successful_results:
         return
+    if timestamp is None:
+        timestamp = datetime.now(LOCAL_TIMEZONE).strftime(REPORT_TIME_FORMAT)
 
     total_orders = 0
     total_units = 0
@@ -129,18 +194,19 @@ async def post_aggregate_summary(results: list):
         inf_list = res.get('inf_items', [])
         orders = int(o.get('orders', 0))
         units = int(o.get('units', 0))
-        uph = float(o.get('uph', 0))
+        uph = o.get('uph_value', 0)
         total_orders += orders
         total_units += units
         if uph > 0:
             fleet_pick_time_sec += (units / uph) * 3600
-        fleet_weighted_lates += float(re.sub(r'[^\d.]', '', o.get('lates', '0'))) * orders
-        fleet_weighted_inf += float(re.sub(r'[^\d.]', '', o.get('inf', '0'))) * units
+        fleet_weighted_lates += o.get('lates_value', 0) * orders
+        fleet_weighted_inf += o.get('inf_value', 0) * units
 
-        uph_f = _format_metric_with_color(f"<b>UPH:</b> {o.get('uph')}", UPH_THRESHOLD, True)
-        lates_f = _format_metric_with_color(f"<b>Lates:</b> {o.get('lates')}", LATES_THRESHOLD)
-        inf_f = _format_metric_with_color(f"<b>INF:</b> {o.get('inf')}", INF_THRESHOLD)
-        metrics_text = f"{uph_f} | {lates_f} | {inf_f}"
+        metrics_text = ' | '.join((
+            _metric_html('UPH', o.get('uph'), o.get('uph_value'), UPH_THRESHOLD, True),
+            _metric_html('Lates', o.get('lates'), o.get('lates_value'), LATES_THRESHOLD),
+            _metric_html('INF', o.get('inf'), o.get('inf_value'), INF_THRESHOLD),
+        ))
         store_widgets.append({'decoratedText': {'icon': {'knownIcon': 'STORE'}, 'topLabel': f"<b>{o['store']}</b> ({orders} Orders)", 'text': metrics_text}})
         if inf_list:
             store_widgets.append({'textParagraph': {'text': f"<i>Top INF: {inf_list[0]['product_name']}</i>"}})
@@ -151,9 +217,9 @@ async def post_aggregate_summary(results: list):
     fleet_lates = (fleet_weighted_lates / total_orders) if total_orders > 0 else 0
     fleet_inf = (fleet_weighted_inf / total_units) if total_units > 0 else 0
     summary_text = (
-        f"• <b>UPH:</b> {_format_metric_with_emoji(f'{fleet_uph:.0f}', UPH_THRESHOLD, True)}<br>"
-        f"• <b>Lates:</b> {_format_metric_with_emoji(f'{fleet_lates:.1f} %', LATES_THRESHOLD)}<br>"
-        f"• <b>INF:</b> {_format_metric_with_emoji(f'{fleet_inf:.1f} %', INF_THRESHOLD)}<br>"
+        f"• <b>UPH:</b> {_format_num_with_emoji(fleet_uph, 0, UPH_THRESHOLD, True)}<br>"
+        f"• <b>Lates:</b> {_format_num_with_emoji(fleet_lates, 1, LATES_THRESHOLD, suffix=' %')}<br>"
+        f"• <b>INF:</b> {_format_num_with_emoji(fleet_inf, 1, INF_THRESHOLD, suffix=' %')}<br>"
         f"• <b>Total Orders:</b> {total_orders}"
     )
     payload = {
@@ -162,7 +228,7 @@ async def post_aggregate_summary(results: list):
             'card': {
                 'header': {
                     'title': 'Amazon North West Summary',
-                    'subtitle': f"{datetime.now(LOCAL_TIMEZONE).strftime('%A %d %B, %H:%M')} | {len(successful_results)} stores",
+                    'subtitle': f"{timestamp} | {len(successful_results)} stores",
                     'imageUrl': 'https://i.pinimg.com/originals/01/ca/da/01cada77a0a7d326d85b7969fe26a728.jpg',
                     'imageType': 'CIRCLE'
                 },
@@ -173,5 +239,5 @@ async def post_aggregate_summary(results: list):
             }
         }]
     }
-    await post_to_webhook(SUMMARY_CHAT_WEBHOOK_URL, payload, 'Fleet', 'summary')
+    await post_to_webhook(SUMMARY_CHAT_WEBHOOK_URL, payload, 'Fleet', 'summary', session)
 
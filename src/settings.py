@@ -1,46 +1,90 @@
 from __future__ import annotations
 import os
-import json
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+from dataclasses import dataclass, field
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
-from pytz import timezone
+from zoneinfo import ZoneInfo
+import orjson
 
-LOCAL_TIMEZONE = timezone('Europe/London')
+LOCAL_TIMEZONE = ZoneInfo('Europe/London')
 
 class LocalTimeFormatter(logging.Formatter):
     def converter(self, ts: float):
         dt = datetime.fromtimestamp(ts, LOCAL_TIMEZONE)
         return dt.timetuple()
 
-def setup_logging():
-    app_logger = logging.getLogger('app')
-    app_logger.setLevel(logging.INFO)
+app_logger = logging.getLogger('app')
+app_logger.setLevel(logging.INFO)
+app_logger.propagate = False
+
+def setup_logging() -> QueueListener:
     app_file = RotatingFileHandler('app.log', maxBytes=10**7, backupCount=5)
     fmt = LocalTimeFormatter('%(asctime)s %(levelname)s %(message)s')
     app_file.setFormatter(fmt)
     console = logging.StreamHandler()
     console.setFormatter(fmt)
-    app_logger.addHandler(app_file)
-    app_logger.addHandler(console)
-    return app_logger
-
-app_logger = setup_logging()
+    log_queue = queue.Queue(-1)
+    app_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, app_file, console, respect_handler_level=True)
+    listener.start()
+    return listener
 
 try:
-    with open('config.json', 'r') as config_file:
-        config = json.load(config_file)
+    with open('config.json', 'rb') as config_file:
+        config = orjson.loads(config_file.read())
 except FileNotFoundError:
     app_logger.critical(
         'config.json not found. Please create it from config.example.json before running.'
     )
     exit(1)
 
-DEBUG_MODE = config.get('debug', False)
-LOGIN_URL = config.get('login_url', 'https://sellercentral.amazon.co.uk/ap/signin')
-CHAT_WEBHOOK_URL = config.get('chat_webhook_url')
-SUMMARY_CHAT_WEBHOOK_URL = config.get('summary_chat_webhook_url')
-TARGET_STORES = config.get('target_stores', [])
+DASHBOARD_URL_TEMPLATE = (
+    'https://sellercentral.amazon.co.uk/snowdash'
+    '?mons_sel_dir_mcid={merchant_id}&mons_sel_mkid={marketplace_id}'
+)
+STORE_REQUIRED_KEYS = ('merchant_id', 'marketplace_id', 'store_name')
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    login_email: str
+    login_password: str
+    otp_secret_key: str | None = None
+    debug: bool = False
+    login_url: str = 'https://sellercentral.amazon.co.uk/ap/signin'
+    chat_webhook_url: str | None = None
+    summary_chat_webhook_url: str | None = None
+    webhook_gzip: bool = False
+    concurrency: int = 4
+    target_stores: list = field(default_factory=list)
+
+    def __post_init__(self):
+        if type(self.concurrency) is not int or self.concurrency < 1:
+            raise ValueError(f"concurrency must be an integer >= 1, got {self.concurrency!r}")
+        for i, store in enumerate(self.target_stores):
+            if not isinstance(store, dict):
+                raise ValueError(f"target_stores[{i}] must be an object, got {store!r}")
+            missing = [k for k in STORE_REQUIRED_KEYS if not store.get(k)]
+            if missing:
+                name = store.get('store_name') or f"target_stores[{i}]"
+                raise ValueError(f"store {name!r} is missing {', '.join(missing)}")
+            store['dash_url'] = DASHBOARD_URL_TEMPLATE.format(
+                merchant_id=store['merchant_id'], marketplace_id=store['marketplace_id']
+            )
+
+try:
+    SETTINGS = Settings(**config)
+except (TypeError, ValueError) as e:
+    app_logger.critical(f'Invalid config.json: {e}')
+    exit(1)
+
+DEBUG_MODE = SETTINGS.debug
+LOGIN_URL = SETTINGS.login_url
+CHAT_WEBHOOK_URL = SETTINGS.chat_webhook_url
+SUMMARY_CHAT_WEBHOOK_URL = SETTINGS.summary_chat_webhook_url
+WEBHOOK_GZIP = SETTINGS.webhook_gzip
+TARGET_STORES = SETTINGS.target_stores
 
 EMOJI_GREEN_CHECK = '\u2705'
 EMOJI_RED_CROSS = '\u274C'
@@ -52,15 +96,29 @@ INF_THRESHOLD = 2.0
 
 SMALL_IMAGE_SIZE = 300
 QR_CODE_SIZE = 60
-WEBHOOK_DELAY_SECONDS = 1.0
+WEBHOOK_MAX_RATE = 5
+WEBHOOK_RATE_PERIOD = 1.0
+WEBHOOK_MAX_ATTEMPTS = 3
+WEBHOOK_MAX_RETRY_AFTER = 60
 
 JSON_LOG_FILE = os.path.join('output', 'submissions.jsonl')
 STORAGE_STATE = 'state.json'
 OUTPUT_DIR = 'output'
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 PAGE_TIMEOUT = 90_000
 ACTION_TIMEOUT = 45_000
 WAIT_TIMEOUT = 45_000
 
 SCRAPE_RETRY_ATTEMPTS = 3
 SCRAPE_RETRY_DELAY = 5
+MAX_CONCURRENT_STORES = SETTINGS.concurrency
+CONTEXT_RECYCLE_EVERY = 10
+CHROMIUM_ARGS = [
+    '--disable-dev-shm-usage',
+    '--disable-gpu',
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-renderer-backgrounding',
+]
+
+def init_output_dir() -> None:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -1,29 +1,64 @@
 from __future__ import annotations
 import os
-import json
+import asyncio
+import orjson
 from datetime import datetime
-from playwright.async_api import Page
-from .settings import OUTPUT_DIR, STORAGE_STATE, LOCAL_TIMEZONE, app_logger
+from urllib.parse import urlsplit
+from playwright.async_api import Page, BrowserContext, Route
+from .settings import OUTPUT_DIR, STORAGE_STATE, LOCAL_TIMEZONE, DEBUG_MODE, app_logger
 
-async def save_screenshot(page: Page | None, prefix: str) -> None:
+BLOCKED_RESOURCE_TYPES = {'image', 'media', 'font'}
+BLOCKED_HOST_SUFFIXES = ('doubleclick.net', 'google-analytics.com', 'googletagmanager.com')
+
+_pending_screenshot_writes: set[asyncio.Task] = set()
+
+def _write_bytes(path: str, data: bytes) -> None:
+    try:
+        with open(path, 'wb') as f:
+            f.write(data)
+    except OSError as e:
+        app_logger.error("Screenshot write error for %s: %s", path, e)
+
+async def save_screenshot(page: Page | None, prefix: str, full_page: bool = DEBUG_MODE) -> None:
     if not page or page.is_closed():
         return
     try:
         path = os.path.join(
             OUTPUT_DIR,
-            f"{prefix}_{datetime.now(LOCAL_TIMEZONE).strftime('%Y%m%d_%H%M%S')}.png"
+            f"{prefix}_{datetime.now(LOCAL_TIMEZONE).strftime('%Y%m%d_%H%M%S')}.jpg"
         )
-        await page.screenshot(path=path, full_page=True, timeout=15000)
-        app_logger.info(f"Screenshot saved: {path}")
+        data = await page.screenshot(full_page=full_page, type="jpeg", quality=60, timeout=15000)
+        task = asyncio.create_task(asyncio.to_thread(_write_bytes, path, data))
+        _pending_screenshot_writes.add(task)
+        task.add_done_callback(_pending_screenshot_writes.discard)
+        app_logger.info("Screenshot saved: %s", path)
     except Exception as e:
-        app_logger.error(f"Screenshot error: {e}")
+        app_logger.error("Screenshot error: %s", e)
 
-def ensure_storage_state() -> bool:
-    if not os.path.exists(STORAGE_STATE) or os.path.getsize(STORAGE_STATE) == 0:
-        return False
+async def flush_screenshots() -> None:
+    if _pending_screenshot_writes:
+        await asyncio.gather(*_pending_screenshot_writes, return_exceptions=True)
+
+def load_storage_state() -> dict | None:
     try:
-        with open(STORAGE_STATE, 'r') as f:
-            data = json.load(f)
-        return isinstance(data, dict) and data.get('cookies')
-    except (json.JSONDecodeError, IOError):
-        return False
+        with open(STORAGE_STATE, 'rb') as f:
+            raw = f.read()
+        if b'"cookies"' not in raw:
+            return None
+        data = orjson.loads(raw)
+    except (orjson.JSONDecodeError, OSError):
+        return None
+    if isinstance(data, dict) and data.get('cookies'):
+        return data
+    return None
+
+async def _filter_route(route: Route) -> None:
+    request = route.request
+    host = urlsplit(request.url).hostname or ''
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or host.endswith(BLOCKED_HOST_SUFFIXES):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def block_heavy_resources(ctx: BrowserContext) -> None:
+    await ctx.route("**/*", _filter_route)